@@ -1,30 +1,149 @@
 #!/usr/bin/python3
 
-import feedparser
+import os
 from os.path import expanduser
-from sqlalchemy import create_engine, select
-from sqlalchemy import ForeignKey, PrimaryKeyConstraint
+from sqlalchemy import and_, bindparam, create_engine, event, func, inspect, select
+from sqlalchemy import ForeignKey, Index, PrimaryKeyConstraint
 from sqlalchemy import MetaData, Sequence
 from sqlalchemy import Table, Column, Integer, String, Date
 import json
-import sys
+from hashlib import sha256
 from argparse import ArgumentParser
 from datetime import datetime
-from time import mktime, sleep
-import subprocess
-from mutagen.easyid3 import EasyID3
+from time import mktime, monotonic, sleep
 import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from threading import Lock
+from urllib.parse import urljoin, urlparse
+
+# Translation table for playlist names: quotes are dropped, and any other
+# character besides spaces and ASCII letters and digits becomes a NUL so
+# that runs of them can be collapsed into a single space.  Entries are
+# filled in as characters are seen instead of for all of Unicode up front.
+class SafeNameTable(dict):
+  def __missing__(self, code):
+    char = chr(code)
+    if char in "'\"":
+      replacement = None
+    elif char == " " or (char.isascii() and char.isalnum()):
+      replacement = code
+    else:
+      replacement = "\0"
+    self[code] = replacement
+    return replacement
+
+SAFE_NAME_TABLE = SafeNameTable()
+
+# Minimum number of seconds between two downloads from the same host
+DOWNLOAD_INTERVAL = 3
+
+class HostRateLimiter:
+  def __init__(self, interval):
+    self.interval = interval
+    self.lock = Lock()
+    self.next_slot = {}
+
+  def wait(self, host):
+    with self.lock:
+      now = monotonic()
+      slot = max(now, self.next_slot.get(host, now))
+      self.next_slot[host] = slot + self.interval
+    if slot > now:
+      sleep(slot - now)
+
+# The feed parser, requests and mutagen are imported where they're used,
+# so that commands like list and add don't pay for loading them
+
+@lru_cache(maxsize = None)
+def _load_feedparser():
+  try:
+    import feedparser_rs as feedparser
+  except ImportError:
+    try:
+      import fastfeedparser as feedparser
+    except ImportError:
+      import feedparser
+  return feedparser
+
+def _configure_sqlite(dbapi_connection, connection_record):
+  # WAL lets refresh workers read while another one writes, and with
+  # synchronous=NORMAL commits no longer wait on an fsync each
+  cursor = dbapi_connection.cursor()
+  cursor.execute("PRAGMA journal_mode=WAL")
+  cursor.execute("PRAGMA synchronous=NORMAL")
+  cursor.execute("PRAGMA temp_store=MEMORY")
+  cursor.execute("PRAGMA mmap_size=268435456")
+  cursor.close()
+
+def _field(record, key, default = None):
+  # The feed parsers disagree on whether records are mappings or objects
+  if isinstance(record, dict):
+    value = record.get(key, default)
+  else:
+    value = getattr(record, key, default)
+  return default if value is None else value
+
+def _as_link(link):
+  return {
+    "type": _field(link, "type", ""),
+    # fastfeedparser reports enclosure URLs under "url"
+    "href": _field(link, "href", _field(link, "url"))
+  }
+
+def _published(entry):
+  published = _field(entry, "published_parsed", 
+                     _field(entry, "date_parsed", 
+                            _field(entry, "updated_parsed")))
+  if published is None:
+    # fastfeedparser only hands back the normalized ISO timestamp
+    try:
+      published = datetime.fromisoformat(_field(entry, "published")).timetuple()
+    except (TypeError, ValueError):
+      pass
+  return published
+
+def _parse_feed(response):
+  feedparser = _load_feedparser()
+  if feedparser.__name__ == "feedparser":
+    # feedparser resolves relative links and guids against Content-Location;
+    # fetching by URL used to supply that, so pass it along with the body
+    headers = { key.lower(): value for key, value in response.headers.items() }
+    headers["content-location"] = urljoin(response.url, headers.get("content-location", ""))
+    return feedparser.parse(response.content, response_headers = headers)
+  return feedparser.parse(response.content)
+
+def _as_entry(entry):
+  links = [ _as_link(link) for link in _field(entry, "links", ()) ]
+  for enclosure in _field(entry, "enclosures", ()):
+    enclosure = _as_link(enclosure)
+    if enclosure not in links:
+      links.append(enclosure)
+  return {
+    "id": _field(entry, "id", _field(entry, "link")),
+    "title": _field(entry, "title", ""),
+    "description": _field(entry, "description", _field(entry, "summary", "")),
+    "published_parsed": _published(entry),
+    "links": links
+  }
 
 class Database:
   def __init__(self, path):
     self.engine = create_engine(path)
+    if self.engine.dialect.name == "sqlite":
+      event.listen(self.engine, "connect", _configure_sqlite)
     self.conn = self.engine.connect()
+    self.session = None
+    self.session_lock = Lock()
     self.metadata = MetaData()
     self.casts = Table('podcasts', self.metadata,
       Column('id', Integer, Sequence('podcasts_id_seq'), primary_key = True),
       Column('url', String),
       Column('name', String),
-      Column('author', String)
+      Column('author', String),
+      Column('etag', String),
+      Column('modified', String),
+      Column('digest', String)
     )
     self.tracks = Table('tracks', self.metadata,
       Column('gid', String),
@@ -34,166 +153,372 @@ class Database:
       Column('published', Date),
       Column('track_url', String),
       Column('track_file', String),
-      PrimaryKeyConstraint('gid', 'podcast')
+      # podcast first, so that the key also serves lookups by podcast
+      PrimaryKeyConstraint('podcast', 'gid')
     )
     self.metadata.create_all(self.engine)
+    self.upgrade_schema()
+
+  def upgrade_schema(self):
+    # create_all() won't add columns to tables from older versions
+    existing = set( column["name"] for column in inspect(self.engine).get_columns(self.casts.name) )
+    for column in self.casts.columns:
+      if column.name not in existing:
+        self.conn.execute("ALTER TABLE {} ADD COLUMN {} {}".format(
+          self.casts.name, column.name, column.type.compile(dialect = self.engine.dialect)
+        ))
+    # Older databases keyed tracks on (gid, podcast), which can't be used to
+    # look up a podcast's tracks, so give those a separate index
+    inspector = inspect(self.engine)
+    primary_key = inspector.get_pk_constraint(self.tracks.name)["constrained_columns"]
+    indexes = set( index["name"] for index in inspector.get_indexes(self.tracks.name) )
+    if primary_key[:1] != ["podcast"] and "ix_tracks_podcast" not in indexes:
+      Index('ix_tracks_podcast', self.tracks.c.podcast).create(self.engine)
 
   def add(self, url):
     ins = self.casts.insert().values(url = url)
     self.conn.execute(ins)
 
   def delete(self, id):
-    d = self.tracks.delete().where(self.tracks.c.podcast == int(id))
-    self.conn.execute(d)
-    d = self.casts.delete().where(self.casts.c.id == int(id))
-    self.conn.execute(d)
+    with self.conn.begin():
+      d = self.tracks.delete().where(self.tracks.c.podcast == int(id))
+      self.conn.execute(d)
+      d = self.casts.delete().where(self.casts.c.id == int(id))
+      self.conn.execute(d)
+
 
+  def get_session(self):
+    # Shared so that feeds and episodes on the same host reuse connections
+    with self.session_lock:
+      if self.session is None:
+        import requests
+        self.session = requests.Session()
+      return self.session
+
+  def upsert_tracks(self, conn, cast, tracks):
+    if len(tracks) == 0:
+      return
+    insert = None
+    try:
+      if self.engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+      elif self.engine.dialect.name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    except ImportError:
+      # SQLite only gained an ON CONFLICT insert in SQLAlchemy 1.4
+      pass
+    if insert is not None:
+      upsert = insert(self.tracks)
+      upsert = upsert.on_conflict_do_update(
+        index_elements = ['podcast', 'gid'],
+        set_ = {
+          'title': upsert.excluded.title,
+          'description': upsert.excluded.description,
+          # An entry that lost its date keeps the one we already have
+          'published': func.coalesce(upsert.excluded.published, self.tracks.c.published),
+          'track_url': upsert.excluded.track_url
+        }
+      )
+      conn.execute(upsert, tracks)
+      return
+    existing_identifier_query = (
+      select([self.tracks.c.gid])
+        .where(self.tracks.c.podcast == cast.id)
+    )
+    # Positional access skips the by-name column lookup on each row
+    existing_gids = set( 
+      row[0] for row in conn.execute(existing_identifier_query) 
+    )
+    # print(existing_gids)
+    inserts = []
+    updates = []
+    for fields in tracks:
+      if fields["gid"] in existing_gids:
+        # print("Update {}: {}".format(cast.name, fields["title"]))
+        fields = dict(fields)
+        fields["track_gid"] = fields.pop("gid")
+        fields["track_published"] = fields.pop("published")
+        del fields["podcast"]
+        updates.append(fields)
+      else:
+        print("Insert {}: {}".format(cast.name, fields["title"]))
+        # Feeds occasionally repeat an entry; later copies become updates
+        existing_gids.add(fields["gid"])
+        inserts.append(fields)
+    if len(inserts) > 0:
+      conn.execute(self.tracks.insert(), inserts)
+    if len(updates) > 0:
+      update_track_query = (
+        self.tracks.update()
+                   .where(and_(self.tracks.c.podcast == cast.id,
+                               self.tracks.c.gid == bindparam("track_gid")))
+                   .values(published = func.coalesce(
+                     bindparam("track_published", type_ = self.tracks.c.published.type),
+                     self.tracks.c.published
+                   ))
+      )
+      conn.execute(update_track_query, updates)
 
   def list(self, id = None):
     list_query = select([self.casts])
     if id is not None:
       list_query = list_query.where(self.casts.c.id == id)
     return [
-      Podcast(self, row["id"], row["url"], row["name"], row["author"])
+      Podcast(self, row["id"], row["url"], row["name"], row["author"], row["etag"], row["modified"], row["digest"])
       for row in self.conn.execute(list_query)
     ]
 
-  def refresh(self, id = None):
-    for cast in self.list(id):
-      cast.refresh()
+  def refresh(self, id = None, workers = 8, casts = None):
+    if casts is None:
+      casts = self.list(id)
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+      list(pool.map(self.refresh_cast, casts))
+
+  def refresh_cast(self, cast):
+    # Each worker thread gets its own connection rather than sharing self.conn
+    with self.engine.connect() as conn:
+      cast.refresh(conn = conn)
 
-  def download(self, directory, id = None, refresh_first = False, update_metadata = False):
-    for cast in self.list(id):
-      if refresh_first:
-        cast.refresh()
-      cast.download(directory, update_metadata = update_metadata)
+  def download(self, directory, id = None, refresh_first = False, update_metadata = False, workers = 4, casts = None):
+    if casts is None:
+      casts = self.list(id)
+    if refresh_first:
+      self.refresh(casts = casts)
+    limiter = HostRateLimiter(DOWNLOAD_INTERVAL)
+    for cast in casts:
+      cast.download(directory, update_metadata = update_metadata, workers = workers, limiter = limiter)
 
-  def update_metadata(self, id = None):
-    for cast in self.list(id):
+  def update_metadata(self, id = None, casts = None):
+    if casts is None:
+      casts = self.list(id)
+    for cast in casts:
       cast.update_metadata()
 
-  def generate_playlists(self, directory, id = None, refresh_first = False, download_first = None, update_metadata = False, path_subst = None):
+  def generate_playlists(self, directory, id = None, refresh_first = False, download_first = None, update_metadata = False, path_subst = None, casts = None):
+    if casts is None:
+      casts = self.list(id)
     if path_subst is not None:
       if type(path_subst) is str:
         path_subst = path_subst.split("^")
     if download_first is not None:
-      self.download(download_first, id = id, refresh_first = refresh_first, update_metadata = update_metadata)
+      self.download(download_first, refresh_first = refresh_first, update_metadata = update_metadata, casts = casts)
     else: 
       if update_metadata:
-        self.update_metadata(id = id)
-    for cast in self.list(id):
-      safe_file_name = re.sub("['\"]", "", cast.name)
-      safe_file_name = re.sub("[^ a-zA-Z0-9]+", " ", safe_file_name)
+        self.update_metadata(casts = casts)
+    for cast in casts:
+      safe_file_name = cast.name.translate(SAFE_NAME_TABLE).split("\0")
+      safe_file_name = " ".join( part for part in safe_file_name if part != "" )
       safe_file_name = safe_file_name.strip()
       # print(safe_file_name)
       cast.dump_to_m3u("{}/{}.m3u".format(directory, safe_file_name), path_subst = path_subst)
 
 class Podcast:
-  def __init__(self, db, id, url, name, author):
+  def __init__(self, db, id, url, name, author, etag = None, modified = None, digest = None):
     self.db = db
     self.id = id
     self.url = url
     self.name = name
     self.author = author
+    self.etag = etag
+    self.modified = modified
+    self.digest = digest
+    self.refreshed = False
 
   def describe(self):
     return "{:02}. \"{}\" by {} ({}...)".format(self.id, self.name, self.author, self.url[:30])
 
-  def refresh(self):
+  def refresh(self, conn = None):
+    if self.refreshed:
+      return
+    self.refreshed = True
+    if conn is None:
+      conn = self.db.conn
     print("Refreshing {}...".format(self.name))
-    data = feedparser.parse(self.url)
-    self.name   = data["channel"]["title"]
-    self.author = data["channel"]["author"]
-    set_meta_update = (
-      self.db.casts.update()
-                   .where(self.db.casts.c.id == self.id)
-                   .values(
-                     name = self.name, 
-                     author = self.author
-                   )
-    )
-    self.db.conn.execute(set_meta_update)
+    headers = {}
+    if self.etag is not None:
+      headers["If-None-Match"] = self.etag
+    if self.modified is not None:
+      headers["If-Modified-Since"] = self.modified
+    import requests
+    try:
+      response = self.db.get_session().get(self.url, headers = headers, timeout = 30)
+      response.raise_for_status()
+    except requests.RequestException as error:
+      print("Failed to refresh {}: {}".format(self.name, error))
+      return
+    if response.status_code == 304:
+      print("{} is unchanged".format(self.name))
+      return
+    self.etag     = response.headers.get("ETag")
+    self.modified = response.headers.get("Last-Modified")
+    digest = sha256(response.content).hexdigest()
+    if digest == self.digest:
+      # Same feed as last time, just served without a usable validator
+      print("{} is unchanged".format(self.name))
+      set_validators_update = (
+        self.db.casts.update()
+                     .where(self.db.casts.c.id == self.id)
+                     .values(etag = self.etag, modified = self.modified)
+      )
+      with conn.begin():
+        conn.execute(set_validators_update)
+      return
+    try:
+      data = _parse_feed(response)
+    except (ValueError, SyntaxError) as error:
+      # fastfeedparser raises on bodies the other parsers flag as bozo
+      print("Failed to parse {}: {}".format(self.name, error))
+      return
+    self.digest = digest
+    feed = _field(data, "feed", {})
+    self.name   = _field(feed, "title", self.name)
+    # fastfeedparser doesn't expose itunes:author, so keep what we had, and
+    # never leave a new podcast without one (mutagen rejects a None artist)
+    self.author = _field(feed, "author", self.author or "")
+    with conn.begin():
+      set_meta_update = (
+        self.db.casts.update()
+                     .where(self.db.casts.c.id == self.id)
+                     .values(
+                       name = self.name, 
+                       author = self.author,
+                       etag = self.etag,
+                       modified = self.modified,
+                       digest = self.digest
+                     )
+      )
+      conn.execute(set_meta_update)
+      new_tracks = []
+      for track in map(_as_entry, _field(data, "entries", ())):
+        # print(trac)
+        fields = {}
+        fields["gid"] = track["id"]
+        fields["podcast"] = self.id
+        fields["title"] = track["title"]
+        fields["description"] = track["description"]
+        fields["published"] = None
+        if track["published_parsed"] is not None:
+          fields["published"] = datetime.fromtimestamp(mktime(track["published_parsed"]))
+        fields["track_url"] = next(
+          ( link["href"] for link in track["links"] 
+            if link["type"].startswith("audio/") and link["href"] is not None ),
+          None
+        )
+        if fields["track_url"] is None:
+          types = set( link["type"] for link in track["links"] )
+          if len(types & set(["text/html"])) == 0:
+            print("Unexpected RSS record for {} without audio track (available track formats are {})".format(track["title"], ", ".join(types)))
+          continue
+        new_tracks.append(fields)
+      self.match_stored_gids(conn, response.url, new_tracks)
+      self.db.upsert_tracks(conn, self, new_tracks)
+
+  def match_stored_gids(self, conn, base, tracks):
+    # Earlier versions let feedparser fetch the feed itself, and it stored
+    # relative guids resolved against the feed URL.  The other parsers (and
+    # feedparser given only the body) may leave them relative, so reuse the
+    # stored form where there is one rather than adding the episode twice.
+    relative = [ 
+      fields for fields in tracks 
+      if fields["gid"] is not None and urlparse(fields["gid"]).scheme == ""
+    ]
+    if len(relative) == 0:
+      return
     existing_identifier_query = (
       select([self.db.tracks.c.gid])
         .where(self.db.tracks.c.podcast == self.id)
     )
     existing_gids = set( 
-      row.gid for row in self.db.conn.execute(existing_identifier_query) 
+      row[0] for row in conn.execute(existing_identifier_query) 
     )
-    # print(existing_gids)
-    for track in data["items"]:
-      # print(trac)
-      fields = {}
-      fields["gid"] = track["id"]
-      fields["podcast"] = self.id
-      fields["title"] = track["title"]
-      fields["description"] = track["description"]
-      if "published_parsed" in track:
-        fields["published"] = datetime.fromtimestamp(mktime(track["published_parsed"]))
-      elif "date_parsed" in track:
-        fields["published"] = datetime.fromtimestamp(mktime(track["date_parsed"]))
-      for link in track["links"]:
-        if "type" in link and link["type"].split("/")[0] == "audio" and "href" in link:
-          fields["track_url"] = link["href"]
-          break
-      if "track_url" not in fields:
-        types = set( link["type"] for link in track["links"] )
-        if len(types & set(["text/html"])) == 0:
-          print("Unexpected RSS record for {} without audio track (available track formats are {})".format(track["title"], ", ".join(types)))
-        continue
-      if fields["track_url"] is not None:
-        # print(fields["published"])
-        if fields["gid"] in existing_gids:
-          # print("Update {}: {}".format(self.name, fields["title"]))
-          gid = fields.pop("gid")
-          # print(gid)
-          del fields["podcast"]
-          # print(fields)
-          insert_or_update_track_query = (
-            self.db.tracks.update()
-                          .where((self.db.tracks.c.podcast == self.id) &
-                                 (self.db.tracks.c.gid == gid))
-                          .values(**fields)
-          )
-          # print(insert_or_update_track_query)
-        else:
-          print("Insert {}: {}".format(self.name, fields["title"]))
-          insert_or_update_track_query = (
-            self.db.tracks.insert()
-                          .values(**fields)
-          )
-        self.db.conn.execute(insert_or_update_track_query)
-
-  def download(self, directory, update_metadata = False):
+    for fields in relative:
+      resolved = urljoin(base, fields["gid"])
+      if fields["gid"] not in existing_gids and resolved in existing_gids:
+        fields["gid"] = resolved
+
+  def download(self, directory, update_metadata = False, workers = 4, limiter = None):
     print("Downloading {}...".format(self.name))
-    for track in self.get_tracks():
-      if track["track_file"] is None:
-        gid = track["gid"].split("/")[-1]
-        if gid != "":
-          file_name = "{}/cast{}-{}.mp3".format(directory, self.id, gid)
-          print(file_name)
-          print("Downloading (in 3 sec) {} -> {}".format(track["track_url"], file_name))
-          sleep(3)
-          subprocess.call(["curl", "-L", "-s", "-o", file_name, track["track_url"]], stdout = sys.stdout)
-          update_track_file = (
-            self.db.tracks.update()
-                          .values(track_file = file_name)
-                          .where(self.db.tracks.c.gid == track["gid"] and 
-                                 self.db.tracks.c.podcast == self.id)
-          )
-          self.db.conn.execute(update_track_file)
-          if update_metadata:
-            self.update_metadata(track, file_name)
-      # else:
-        # print("Already Have {}".format(track["track_file"]))
-        # if update_metadata:
-        #   self.update_metadata(track)
-
-  def get_tracks(self):
-    return self.db.conn.execute(
+    if limiter is None:
+      limiter = HostRateLimiter(DOWNLOAD_INTERVAL)
+    pending = []
+    for track in self.get_missing_tracks():
+      gid = track["gid"].split("/")[-1]
+      if gid != "":
+        pending.append((track, "{}/cast{}-{}.mp3".format(directory, self.id, gid)))
+    update_track_file = (
+      self.db.tracks.update()
+                    .values(track_file = bindparam("file_name"))
+                    .where(and_(self.db.tracks.c.podcast == self.id,
+                                self.db.tracks.c.gid == bindparam("track_gid")))
+    )
+    downloaded = []
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+      jobs = {
+        pool.submit(self.download_track, track, file_name, limiter): (track, file_name)
+        for track, file_name in pending
+      }
+      for job in as_completed(jobs):
+        if job.result():
+          track, file_name = jobs[job]
+          # Record each file as it lands, so an interrupted run keeps its progress
+          with self.db.conn.begin():
+            self.db.conn.execute(update_track_file, { "track_gid": track["gid"], "file_name": file_name })
+          downloaded.append((track, file_name))
+    # Tagging waits until every download is recorded, and a file that
+    # can't be tagged is reported rather than stopping the rest
+    if update_metadata:
+      from mutagen import MutagenError
+      for track, file_name in downloaded:
+        try:
+          self.update_metadata(track, file_name)
+        except (MutagenError, ValueError, OSError) as error:
+          print("Failed to update metadata for {}: {}".format(file_name, error))
+
+  def download_track(self, track, file_name, limiter):
+    url = track["track_url"]
+    limiter.wait(urlparse(url).netloc)
+    print("Downloading {} -> {}".format(url, file_name))
+    partial_file_name = file_name + ".part"
+    import requests
+    try:
+      with self.db.get_session().get(url, stream = True, timeout = 30) as response:
+        response.raise_for_status()
+        with open(partial_file_name, "wb") as output:
+          # iter_content, unlike reading response.raw, wraps urllib3's
+          # errors (e.g. a truncated body) in RequestException
+          for chunk in response.iter_content(chunk_size = 1 << 20):
+            output.write(chunk)
+    except (requests.RequestException, OSError) as error:
+      print("Failed to download {}: {}".format(url, error))
+      try:
+        os.remove(partial_file_name)
+      except FileNotFoundError:
+        pass
+      return False
+    os.replace(partial_file_name, file_name)
+    return True
+
+  def get_tracks(self, limit = None, newest_first = False, downloaded_only = False):
+    tracks_query = (
       select([self.db.tracks])
         .where(self.db.tracks.c.podcast == self.id)
     )
+    if downloaded_only:
+      tracks_query = tracks_query.where(self.db.tracks.c.track_file.isnot(None))
+    if newest_first:
+      tracks_query = tracks_query.order_by(self.db.tracks.c.published.desc())
+    if limit is not None:
+      tracks_query = tracks_query.limit(limit)
+    return self.db.conn.execute(tracks_query)
+
+  def get_missing_tracks(self):
+    # Only the columns download() and update_metadata() need; descriptions can be long
+    return self.db.conn.execute(
+      select([self.db.tracks.c.gid, self.db.tracks.c.title, 
+              self.db.tracks.c.published, self.db.tracks.c.track_url])
+        .where(and_(self.db.tracks.c.podcast == self.id,
+                    self.db.tracks.c.track_file.is_(None)))
+    )
 
   def update_metadata(self, track = None, file_override = None):
     if track == None:
@@ -221,41 +546,51 @@ class Podcast:
         #  'asin', 'performer', 'barcode', 'catalognumber', 
         #  'musicbrainz_releasetrackid', 'musicbrainz_releasegroupid', 
         #  'musicbrainz_workid', 'acoustid_fingerprint', 'acoustid_id']
+        from mutagen.easyid3 import EasyID3
         track_meta = EasyID3(track_file)
-        track_meta["album"] = self.name
-        track_meta["artist"] = self.author
-        track_meta["genre"] = "Podcast"
-        track_meta["title"] = track["title"]
-        track_meta["date"] = "{}-{}-{}".format(track["published"].year, track["published"].month, track["published"].day)
+        desired_meta = {
+          "album": self.name,
+          "genre": "Podcast",
+          "title": track["title"]
+        }
+        if track["published"] is not None:
+          # Zero padded, as mutagen reads it back, so the comparison below can match
+          desired_meta["date"] = track["published"].strftime("%Y-%m-%d")
+        # Feeds without an author (and fastfeedparser, which can't see
+        # itunes:author) leave the artist tag alone
+        if self.author:
+          desired_meta["artist"] = self.author
+        # Saving rewrites the tag (or the whole file), so skip it when nothing changed
+        if all( track_meta.get(key) == [value] for key, value in desired_meta.items() ):
+          return
+        track_meta.update(desired_meta)
         print(track_meta)
-        track_meta.save()
+        # Leave room in the header so that later edits can be made in place
+        track_meta.save(padding = lambda info: max(1024, info.padding))
 
   def dump_to_m3u(self, file, limit = None, extm3u = True, path_subst = None):
-    with open(file, "w+") as output:
-      tracks = self.get_tracks()
-      if limit is not None:
-        tracks = tracks[:limit]
-      if extm3u:
-        output.write("#EXTM3U\n\n")
-      tracks = sorted(tracks, key = lambda x: x["published"], reverse = True)
-      for track in tracks:
-        track_file = track["track_file"]
-        if track_file is not None:
-          if extm3u:
-            output.write("#EXTINF:-1, ")
-            output.write(track["title"])
-            output.write("\n")
-          if path_subst:
-            track_file = re.sub(path_subst[0], path_subst[1], track_file)
-          output.write(track_file)
-          if extm3u:
-            output.write("\n\n")
-          else:
-            output.write("\n")
+    # Filter in SQL so that the limit counts only tracks that make it into the playlist
+    tracks = self.get_tracks(limit = limit, newest_first = True, downloaded_only = True)
+    if path_subst:
+      subst_pattern = re.compile(path_subst[0])
+    lines = []
+    if extm3u:
+      lines.append("#EXTM3U\n\n")
+    for track in tracks:
+      track_file = track["track_file"]
+      if track_file is not None:
+        if path_subst:
+          track_file = subst_pattern.sub(path_subst[1], track_file)
+        if extm3u:
+          lines.append("#EXTINF:-1, {}\n{}\n\n".format(track["title"], track_file))
+        else:
+          lines.append("{}\n".format(track_file))
+    with open(file, "w+", buffering = 1 << 20) as output:
+      output.write("".join(lines))
 
 
 
-if __name__ == '__main__':
+def main():
   with open(expanduser("~/.podcastrc")) as pref_file:
     prefs = json.load(pref_file)
   # print(prefs["db"])
@@ -277,14 +612,16 @@ if __name__ == '__main__':
 
   parser_refresh = subparsers.add_parser("refresh", help = "Update with recent casts")
   parser_refresh.add_argument("--cast", type = int, default = None, help = "The ID of a specific podcast to refresh")
-  parser_refresh.set_defaults(func = lambda args: db.refresh(id = args.cast))
+  parser_refresh.add_argument("--parallel", type = int, default = 8, help = "The number of podcasts to refresh at once")
+  parser_refresh.set_defaults(func = lambda args: db.refresh(id = args.cast, workers = args.parallel))
 
   parser_download = subparsers.add_parser("download", help = "Download unavailable casts")
   parser_download.add_argument("directory", type = str, help = "The directory to download to")
   parser_download.add_argument("--refresh", action = 'store_true', help = "Refresh the podcast first")
   parser_download.add_argument("--metadata", action = 'store_true', help = "Overwrite the MP3 metadata with feed values")
   parser_download.add_argument("--cast", type = int, default = None, help = "The ID of a specific podcast to download")
-  parser_download.set_defaults(func = lambda args: db.download(args.directory, id = args.cast, refresh_first = args.refresh, update_metadata = args.metadata))
+  parser_download.add_argument("--parallel", type = int, default = 4, help = "The number of casts to download at once")
+  parser_download.set_defaults(func = lambda args: db.download(args.directory, id = args.cast, refresh_first = args.refresh, update_metadata = args.metadata, workers = args.parallel))
 
   parser_update_meta = subparsers.add_parser("update-metadata", help = "Update metadata for all downloaded podcasts") 
   parser_update_meta.set_defaults(func = lambda args: db.update_metadata())
@@ -306,3 +643,6 @@ if __name__ == '__main__':
 
   args = parser.parse_args()
   args.func(args)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,206 @@
+from datetime import date
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import importlib
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from mutagen.easyid3 import EasyID3
+from mutagen.id3 import ID3
+
+import Podcast
+
+FEED_URL = "http://host/feed.xml"
+
+FEED = b"""<?xml version="1.0"?>
+<rss version="2.0" xmlns:itunes="http://www.itunes.com/dtds/podcast-1.0.dtd">
+  <channel>
+    <title>Show</title>
+    <itunes:author>Someone</itunes:author>
+    <item>
+      <title>Episode 1</title>
+      <guid>g1</guid>
+      <description>The first one</description>
+      <pubDate>Mon, 06 Jan 2020 10:00:00 GMT</pubDate>
+      <enclosure url="http://host/g1.mp3" type="audio/mpeg" length="1"/>
+    </item>
+  </channel>
+</rss>
+"""
+
+# The schema as it was before etag/modified/digest and the (podcast, gid) key
+BASELINE_SCHEMA = """
+CREATE TABLE podcasts (
+  id INTEGER NOT NULL PRIMARY KEY,
+  url VARCHAR,
+  name VARCHAR,
+  author VARCHAR
+);
+CREATE TABLE tracks (
+  gid VARCHAR NOT NULL,
+  podcast INTEGER REFERENCES podcasts (id),
+  title VARCHAR,
+  description VARCHAR,
+  published DATE,
+  track_url VARCHAR,
+  track_file VARCHAR,
+  PRIMARY KEY (gid, podcast)
+);
+"""
+
+class FakeResponse:
+  def __init__(self, body, url):
+    self.content = body
+    self.url = url
+    self.status_code = 200
+    self.headers = { "Content-Type": "application/rss+xml" }
+
+  def raise_for_status(self):
+    pass
+
+class FakeSession:
+  def get(self, url, headers = None, timeout = None, stream = False):
+    return FakeResponse(FEED, url)
+
+def import_parser(test, parser):
+  try:
+    return importlib.import_module(parser)
+  except ImportError:
+    test.skipTest("{} is not installed".format(parser))
+
+class MigrationTest(unittest.TestCase):
+  def setUp(self):
+    directory = tempfile.TemporaryDirectory()
+    self.addCleanup(directory.cleanup)
+    self.path = os.path.join(directory.name, "podcasts.db")
+    baseline = sqlite3.connect(self.path)
+    baseline.executescript(BASELINE_SCHEMA)
+    baseline.execute("INSERT INTO podcasts VALUES (1, ?, 'Show', 'Someone')", (FEED_URL,))
+    # feedparser.parse(url) resolved the relative guid against the feed URL
+    baseline.execute(
+      "INSERT INTO tracks VALUES ('http://host/g1', 1, 'Episode 1', 'The first one', "
+      "'2020-01-06', 'http://host/g1.mp3', '/music/cast1-g1.mp3')"
+    )
+    baseline.commit()
+    baseline.close()
+
+  def refresh_with(self, parser):
+    module = import_parser(self, parser)
+    db = Podcast.Database("sqlite:///" + self.path)
+    db.session = FakeSession()
+    with mock.patch.object(Podcast, "_load_feedparser", lambda: module):
+      db.refresh()
+    return db
+
+  def assert_migrated(self, parser):
+    db = self.refresh_with(parser)
+    tracks = [ tuple(row) for row in db.conn.execute(
+      "SELECT gid, title, track_file FROM tracks"
+    ) ]
+    self.assertEqual(tracks, [ ("http://host/g1", "Episode 1", "/music/cast1-g1.mp3") ])
+    (cast,) = db.list()
+    self.assertEqual((cast.name, cast.author), ("Show", "Someone"))
+    self.assertIsNotNone(cast.digest)
+
+  def test_feedparser(self):
+    self.assert_migrated("feedparser")
+
+  def test_feedparser_rs(self):
+    self.assert_migrated("feedparser_rs")
+
+  def test_fastfeedparser(self):
+    self.assert_migrated("fastfeedparser")
+
+class NewPodcastTest(unittest.TestCase):
+  def setUp(self):
+    directory = tempfile.TemporaryDirectory()
+    self.addCleanup(directory.cleanup)
+    self.directory = directory.name
+
+  def assert_tags(self, parser):
+    module = import_parser(self, parser)
+    db = Podcast.Database("sqlite:///" + os.path.join(self.directory, "podcasts.db"))
+    db.session = FakeSession()
+    db.add(FEED_URL)
+    with mock.patch.object(Podcast, "_load_feedparser", lambda: module):
+      db.refresh()
+    (cast,) = db.list()
+    self.assertIsNotNone(cast.author)
+    track_file = os.path.join(self.directory, "cast1-g1.mp3")
+    ID3().save(track_file)
+    (track,) = cast.get_tracks()
+    cast.update_metadata(track, track_file)
+    tags = EasyID3(track_file)
+    self.assertEqual(tags["album"], [ "Show" ])
+    if cast.author:
+      self.assertEqual(tags["artist"], [ cast.author ])
+    else:
+      self.assertNotIn("artist", tags)
+    self.assertEqual(tags["date"], [ "2020-01-06" ])
+
+  def test_feedparser(self):
+    self.assert_tags("feedparser")
+
+  def test_feedparser_rs(self):
+    self.assert_tags("feedparser_rs")
+
+  # fastfeedparser has no itunes:author, so this podcast never gets one
+  def test_fastfeedparser(self):
+    self.assert_tags("fastfeedparser")
+
+class EpisodeHandler(BaseHTTPRequestHandler):
+  episodes = {}
+
+  def do_GET(self):
+    body = self.episodes[self.path]
+    self.send_response(200)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+class DownloadTest(unittest.TestCase):
+  def setUp(self):
+    directory = tempfile.TemporaryDirectory()
+    self.addCleanup(directory.cleanup)
+    self.directory = directory.name
+    tagged = os.path.join(self.directory, "tagged.mp3")
+    ID3().save(tagged)
+    with open(tagged, "rb") as episode:
+      EpisodeHandler.episodes = {
+        "/e1.mp3": episode.read(),
+        # No ID3 header, so mutagen refuses to tag it
+        "/e2.mp3": b"not an mp3",
+      }
+    EpisodeHandler.episodes["/e3.mp3"] = EpisodeHandler.episodes["/e1.mp3"]
+    server = HTTPServer(("127.0.0.1", 0), EpisodeHandler)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    self.addCleanup(server.server_close)
+    self.addCleanup(server.shutdown)
+    self.base = "http://127.0.0.1:{}".format(server.server_port)
+
+  def test_untaggable_episode_does_not_lose_downloads(self):
+    db = Podcast.Database("sqlite:///" + os.path.join(self.directory, "podcasts.db"))
+    db.add(FEED_URL)
+    db.conn.execute(db.casts.update().values(name = "Show", author = "Someone"))
+    for gid in ("e1", "e2", "e3"):
+      db.conn.execute(db.tracks.insert().values(
+        gid = "http://host/" + gid, podcast = 1, title = gid,
+        published = date(2020, 1, 6), track_url = "{}/{}.mp3".format(self.base, gid)
+      ))
+    with mock.patch.object(Podcast, "DOWNLOAD_INTERVAL", 0):
+      db.download(self.directory, update_metadata = True)
+    tracks = dict( tuple(row) for row in db.conn.execute("SELECT gid, track_file FROM tracks") )
+    self.assertEqual(tracks, {
+      "http://host/" + gid: os.path.join(self.directory, "cast1-{}.mp3".format(gid))
+      for gid in ("e1", "e2", "e3")
+    })
+    self.assertEqual(EasyID3(tracks["http://host/e3"])["title"], [ "e3" ])
+
+if __name__ == '__main__':
+  unittest.main()